@@ -2,16 +2,17 @@
 # SPDX-License-Identifier: LGPL-2.1+
 # systemd-networkd tests
 
+import mmap
 import os
 import sys
 import unittest
 import subprocess
 import time
 import re
+import select
 import shutil
 import signal
 import socket
-import threading
 from shutil import copytree
 
 network_unit_file_path='/var/run/systemd/network'
@@ -22,11 +23,48 @@ network_sysctl_ipv4_path='/proc/sys/net/ipv4/conf'
 dnsmasq_config_file='/var/run/networkd-ci/test-dnsmasq.conf'
 dnsmasq_pid_file='/var/run/networkd-ci/test-test-dnsmasq.pid'
 dnsmasq_log_file='/var/run/networkd-ci/test-dnsmasq-log-file'
+dnsmasq_lease_file='/var/run/networkd-ci/lease'
+
+# needles searched for in the dnsmasq log, encoded once at import
+needle_vendor_class=b'vendor class: SusantVendorTest'
+needle_client_mac=b'client MAC address: 12:34:56:78:9a:bc'
+needle_client_hostname=b'client provides name: test-hostname'
+needle_mtu=b'26:mtu'
+needle_rapid_commit=b'14:rapid-commit'
+needle_vci=b'VendorClassIdentifier=SusantVendorTest'
+needle_hostname=b'test-hostname'
+
+# resolve the tools we fork all the time once, so every subprocess
+# invocation is spared the PATH walk
+ip_bin=shutil.which('ip') or '/sbin/ip'
+networkctl_bin=shutil.which('networkctl') or '/usr/bin/networkctl'
+bridge_bin=shutil.which('bridge') or '/sbin/bridge'
+systemctl_bin=shutil.which('systemctl') or '/usr/bin/systemctl'
+dnsmasq_bin=shutil.which('dnsmasq') or '/usr/sbin/dnsmasq'
+
+module_available_cache = {}
+
+_verbose = '-v' in sys.argv or bool(os.environ.get('NETWORKD_TEST_VERBOSE'))
+
+def _dbg(*args, **kwargs):
+    if not _verbose:
+        return
+
+    for arg in args:
+        # command output is passed around undecoded these days, write
+        # it straight to the underlying buffer
+        if isinstance(arg, bytes):
+            sys.stdout.buffer.write(arg + b'\n')
+        else:
+            print(arg, **kwargs)
 
 def is_module_available(module_name):
-    lsmod_output = subprocess.check_output('lsmod', universal_newlines=True)
-    module_re = re.compile(r'^{0}\b'.format(re.escape(module_name)), re.MULTILINE)
-    return module_re.search(lsmod_output) or not subprocess.call(["modprobe", module_name])
+    if module_name not in module_available_cache:
+        with open('/proc/modules') as f:
+            loaded_modules = set(line.split(' ', 1)[0] for line in f)
+        module_available_cache[module_name] = module_name in loaded_modules or not subprocess.call(["modprobe", module_name])
+
+    return module_available_cache[module_name]
 
 def expectedFailureIfModuleIsNotAvailable(module_name):
     def f(func):
@@ -36,13 +74,22 @@ def expectedFailureIfModuleIsNotAvailable(module_name):
 
     return f
 
+def _link_or_copy(src, dst, *, follow_symlinks=True):
+    # hardlink if source and destination are on the same filesystem,
+    # copying every byte is only needed as the cross-device fallback
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst, follow_symlinks=follow_symlinks)
+
 def setUpModule():
 
     os.makedirs(network_unit_file_path, exist_ok=True)
-    os.makedirs(networkd_ci_path, exist_ok=True)
 
-    shutil.rmtree(networkd_ci_path)
-    copytree(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf'), networkd_ci_path)
+    if os.path.isdir(networkd_ci_path):
+        shutil.rmtree(networkd_ci_path)
+    copytree(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf'), networkd_ci_path,
+             copy_function=_link_or_copy)
 
 def tearDownModule():
     shutil.rmtree(networkd_ci_path)
@@ -51,102 +98,283 @@ class Utilities():
     dhcp_server_data = []
 
     def read_link_attr(self, link, dev, attribute):
-        with open(os.path.join(os.path.join(os.path.join('/sys/class/net/', link), dev), attribute)) as f:
-            return f.readline().strip()
+        with open(os.path.join('/sys/class/net', link, dev, attribute)) as f:
+            return f.read().strip()
+
+    def _net_links(self):
+        # one getdents() returns all interfaces at once, so list the
+        # directory and keep the result around briefly instead of
+        # stat()ing every queried link separately
+        cache = self.__dict__.get('_net_links_cache')
+        now = time.monotonic()
+        if cache and now - cache[0] < 0.1:
+            return cache[1]
+
+        links = set(entry.name for entry in os.scandir('/sys/class/net'))
+        self._net_links_cache = (now, links)
+        return links
 
     def link_exits(self, link):
-        return os.path.exists(os.path.join('/sys/class/net', link))
+        return link in self._net_links()
+
+    def wait_link_exits(self, link, timeout=10):
+        # the link usually shows up within a few milliseconds of the
+        # networkd restart, so start with a tiny sleep and back off
+        # exponentially rather than blocking for a fixed interval
+        delay = 0.01
+        deadline = time.monotonic() + timeout
+        while not self.link_exits(link):
+            if time.monotonic() > deadline:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+        return self.link_exits(link)
+
+    def _show(self, *command):
+        # memoize the output per test instance, so that several
+        # assertions against the same command spawn it only once
+        cache = self.__dict__.setdefault('_show_cache', {})
+        if command not in cache:
+            cache[command] = subprocess.check_output(command, close_fds=False).rstrip().decode('utf-8')
+        return cache[command]
+
+    def _run(self, *command):
+        # no decoding: the callers only regex-match the output, which
+        # works just as well on the raw bytes
+        return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              check=True, close_fds=False).stdout
+
+    def _show_batch(self, *commands):
+        # run several queries with a single fork of the shell and split
+        # the combined output again on a sentinel that cannot occur in
+        # ip/networkctl output
+        # '&&' rather than ';', so a failure of any of the commands
+        # fails the whole batch instead of being silently swallowed
+        shell_command = ' && echo __SEP__ && '.join(' '.join(command) for command in commands)
+        output = subprocess.run(shell_command, shell=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, check=True).stdout
+        return [part.strip() for part in output.split(b'__SEP__')]
 
     def link_remove(self, links):
+        commands = ''
         for link in links:
             if os.path.exists(os.path.join('/sys/class/net', link)):
-                subprocess.call(['ip', 'link', 'del', 'dev', link])
-        time.sleep(1)
+                commands += 'link del dev {}\n'.format(link)
+
+        if not commands:
+            return
+
+        # delete all leftover links with a single ip invocation, and poll
+        # for them to be gone instead of sleeping a fixed second; -force
+        # keeps the batch going when an entry already vanished because
+        # deleting its parent device took it down
+        subprocess.run([ip_bin, '-force', '-batch', '-'], input=commands, universal_newlines=True,
+                       stderr=subprocess.DEVNULL)
+
+        for _ in range(100):
+            if not any(os.path.exists(os.path.join('/sys/class/net', link)) for link in links):
+                break
+            time.sleep(0.02)
 
     def read_ipv6_sysctl_attr(self, link, attribute):
-        with open(os.path.join(os.path.join(network_sysctl_ipv6_path, link), attribute)) as f:
-            return f.readline().strip()
+        with open(os.path.join(network_sysctl_ipv6_path, link, attribute)) as f:
+            return f.read().strip()
 
     def read_ipv4_sysctl_attr(self, link, attribute):
-        with open(os.path.join(os.path.join(network_sysctl_ipv4_path, link), attribute)) as f:
-            return f.readline().strip()
+        with open(os.path.join(network_sysctl_ipv4_path, link, attribute)) as f:
+            return f.read().strip()
+
+    # unit name -> (st_mtime_ns, st_size) of the installed source, so a
+    # unit that is still in place from an earlier copy is not installed
+    # again; remove_unit_from_networkd_path() invalidates the entries
+    copied_units = {}
 
     def copy_unit_to_networkd_unit_path(self, *units):
-        for unit in units:
-            shutil.copy(os.path.join(networkd_ci_path, unit), network_unit_file_path)
+        # tolerate the same unit being named twice in one call
+        for unit in dict.fromkeys(units):
+            src = os.path.join(networkd_ci_path, unit)
+            dst = os.path.join(network_unit_file_path, unit)
 
-    def remove_unit_from_networkd_path(self, units):
-        for unit in units:
-            if (os.path.exists(os.path.join(network_unit_file_path, unit))):
-                os.remove(os.path.join(network_unit_file_path, unit))
+            st = os.stat(src)
+            key = (st.st_mtime_ns, st.st_size)
+            if Utilities.copied_units.get(unit) == key:
+                continue
 
-    def start_dnsmasq(self):
-        subprocess.check_call('dnsmasq -8 /var/run/networkd-ci/test-dnsmasq-log-file --log-queries=extra --log-dhcp --pid-file=/var/run/networkd-ci/test-test-dnsmasq.pid --conf-file=/dev/null --interface=veth-peer --enable-ra --dhcp-range=2600::10,2600::20 --dhcp-range=192.168.5.10,192.168.5.200 -R --dhcp-leasefile=/var/run/networkd-ci/lease --dhcp-option=26,1492 --dhcp-option=option:router,192.168.5.1 --dhcp-option=33,192.168.5.4,192.168.5.5', shell=True)
+            # a hardlink is enough, networkd only ever reads the files
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy(src, dst)
 
-        time.sleep(10)
+            Utilities.copied_units[unit] = key
+
+    def remove_unit_from_networkd_path(self, units):
+        # a single scandir() tells us which of the units are actually
+        # installed, instead of a stat() per list entry
+        try:
+            present = set(entry.name for entry in os.scandir(network_unit_file_path))
+        except FileNotFoundError:
+            return
+
+        for unit in present.intersection(units):
+            try:
+                os.remove(os.path.join(network_unit_file_path, unit))
+            except FileNotFoundError:
+                pass
+            Utilities.copied_units.pop(unit, None)
+
+    def start_dnsmasq(self, lease_time=None):
+        ipv4_range = '--dhcp-range=192.168.5.10,192.168.5.200'
+        if lease_time:
+            ipv4_range += ',' + lease_time
+
+        subprocess.check_call([dnsmasq_bin,
+                               '-8', dnsmasq_log_file,
+                               '--log-queries=extra',
+                               '--log-dhcp',
+                               '--pid-file={}'.format(dnsmasq_pid_file),
+                               '--conf-file=/dev/null',
+                               '--interface=veth-peer',
+                               '--enable-ra',
+                               '--dhcp-range=2600::10,2600::20',
+                               ipv4_range,
+                               '-R',
+                               '--dhcp-leasefile={}'.format(dnsmasq_lease_file),
+                               '--dhcp-option=26,1492',
+                               '--dhcp-option=option:router,192.168.5.1',
+                               '--dhcp-option=33,192.168.5.4,192.168.5.5'])
+
+        # dnsmasq writes its pid file once it is ready to serve, and adds an
+        # entry to the lease file as soon as the handshake with networkd is
+        # done, so poll for those instead of sleeping a fixed 10 seconds
+        for _ in range(100):
+            if os.path.exists(dnsmasq_pid_file):
+                break
+            time.sleep(0.1)
+
+        for _ in range(100):
+            if os.path.exists(dnsmasq_lease_file) and os.path.getsize(dnsmasq_lease_file) > 0:
+                break
+            time.sleep(0.1)
 
     def stop_dnsmasq(self, pid_file):
-        if os.path.exists(pid_file):
+        try:
             with open(pid_file, 'r') as f:
-                pid = f.read().rstrip(' \t\r\n\0')
-                os.kill(int(pid), signal.SIGTERM)
-
+                pid = int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return
+
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+        # wait for the process to be gone, otherwise the next
+        # start_dnsmasq() races against the old instance still holding
+        # the DHCP sockets
+        for _ in range(200):
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                break
+            time.sleep(0.01)
+
+        try:
             os.remove(pid_file)
+        except FileNotFoundError:
+            pass
 
-    def search_words_in_file(self, word):
-        if os.path.exists(dnsmasq_log_file):
-            with open (dnsmasq_log_file) as in_file:
-                contents = in_file.read()
-                print(contents)
-                for part in contents.split():
-                    if word in part:
-                        in_file.close()
-                        print("%s, %s" % (word, part))
-                        return True
-        return False
+    def _dnsmasq_log(self):
+        # keep the mapping around between look-ups; the size check
+        # remaps the file when dnsmasq appended more output meanwhile
+        try:
+            size = os.path.getsize(dnsmasq_log_file)
+        except FileNotFoundError:
+            return None
+        if size == 0:
+            return None
 
-    def remove_lease_file(self):
-        if os.path.exists(os.path.join(networkd_ci_path, 'lease')):
-            os.remove(os.path.join(networkd_ci_path, 'lease'))
+        cached = self.__dict__.get('_dnsmasq_log_cache')
+        if cached and cached[0] == size:
+            return cached[1]
 
-    def remove_log_file(self):
-        if os.path.exists(dnsmasq_log_file):
-            os.remove(dnsmasq_log_file)
+        with open(dnsmasq_log_file, 'rb') as in_file:
+            contents = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
 
-    def start_networkd(self):
-        subprocess.check_call('systemctl restart systemd-networkd', shell=True)
-        time.sleep(5)
+        self._dnsmasq_log_cache = (size, contents)
+        return contents
 
-global ip
-global port
+    def search_words_in_file(self, word):
+        contents = self._dnsmasq_log()
+        if contents is None:
+            return False
 
-class DHCPServer(threading.Thread):
-    def __init__(self, name):
-        threading.Thread.__init__(self)
-        self.name = name
+        if isinstance(word, str):
+            word = word.encode()
 
-    def run(self):
-        self.start_dhcp_server()
+        return contents.find(word) != -1
 
-    def start_dhcp_server(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def scan_words_in_file(self, *words):
+        # look for a whole set of needles against the one mapping and
+        # return those that were found
+        contents = self._dnsmasq_log()
+        if contents is None:
+            return set()
 
-        server_address = ('0.0.0.0', 67)
-        sock.bind(server_address)
+        return set(word for word in words
+                   if contents.find(word.encode() if isinstance(word, str) else word) != -1)
 
-        print('Starting DHCP Server ...\n')
-        data, addr = sock.recvfrom(1024) # buffer size is 1024 bytes
+    def remove_lease_file(self):
+        if os.path.exists(dnsmasq_lease_file):
+            os.remove(dnsmasq_lease_file)
 
-        global ip
-        ip = addr[0]
+    def remove_log_file(self):
+        if os.path.exists(dnsmasq_log_file):
+            os.remove(dnsmasq_log_file)
 
-        global port
-        port = addr[1]
-        sock.close()
+    def start_networkd(self):
+        subprocess.check_call([systemctl_bin, 'restart', 'systemd-networkd'])
+
+        # the restart job only completes once networkd has reported
+        # readiness, so it is enough to wait for the state file to show
+        # up instead of sleeping a fixed 5 seconds
+        for _ in range(50):
+            if os.path.exists('/run/systemd/netif/state'):
+                break
+            time.sleep(0.1)
+
+    def _wait_routable(self, link, timeout=15):
+        # poll until the link is fully configured instead of sleeping a
+        # fixed time, and return the final status output so the caller
+        # can run its own assertions against it
+        deadline = time.monotonic() + timeout
+        while True:
+            output = subprocess.check_output([networkctl_bin, 'status', link],
+                                             close_fds=False).rstrip().decode('utf-8')
+            if 'routable' in output:
+                return output
+            if time.monotonic() > deadline:
+                self.fail('{} not routable after {} seconds'.format(link, timeout))
+            time.sleep(0.1)
+
+    def _poll_output(self, command, patterns, timeout=10):
+        # networkd applies configuration asynchronously after the link
+        # shows up, so re-run the query until every pattern matches; on
+        # timeout the last output is returned and the caller's regular
+        # assertions produce the failure message
+        deadline = time.monotonic() + timeout
+        while True:
+            output = subprocess.check_output(command, close_fds=False).rstrip().decode('utf-8')
+            if all(re.search(pattern, output) for pattern in patterns):
+                return output
+            if time.monotonic() > deadline:
+                return output
+            time.sleep(0.1)
 
 class NetworkdNetDevTests(unittest.TestCase, Utilities):
 
-    links =['bridge99', 'bond99', 'bond99', 'vlan99', 'test1', 'macvtap99',
+    links =['bridge99', 'bond99', 'vlan99', 'test1', 'macvtap99',
             'macvlan99', 'ipvlan99', 'vxlan99', 'veth99', 'vrf99', 'tun99',
             'tap99', 'vcan99', 'geneve99', 'dummy98', 'ipiptun99', 'sittun99', '6rdtun99',
             'gretap99', 'vtitun99', 'vti6tun99','ip6tnl99', 'gretun99', 'ip6gretap99', 'wg99']
@@ -154,7 +382,7 @@ class NetworkdNetDevTests(unittest.TestCase, Utilities):
     units = ['25-bridge.netdev', '25-bond.netdev', '21-vlan.netdev', '11-dummy.netdev', '21-vlan.network',
              '21-macvtap.netdev', 'macvtap.network', '21-macvlan.netdev', 'macvlan.network', 'vxlan.network',
              '25-vxlan.netdev', '25-ipvlan.netdev', 'ipvlan.network', '25-veth.netdev', '25-vrf.netdev',
-             '25-tun.netdev', '25-tun.netdev', '25-vcan.netdev', '25-geneve.netdev', '25-ipip-tunnel.netdev',
+             '25-tun.netdev', '25-vcan.netdev', '25-geneve.netdev', '25-ipip-tunnel.netdev',
              '25-ip6tnl-tunnel.netdev', '25-ip6gre-tunnel.netdev','25-sit-tunnel.netdev', '25-6rd-tunnel.netdev',
              '25-gre-tunnel.netdev', '25-gretap-tunnel.netdev', '25-vti-tunnel.netdev', '25-vti6-tunnel.netdev',
              '12-dummy.netdev', 'gre.network', 'ipip.network', 'ip6gretap.network', 'gretun.network',
@@ -172,7 +400,7 @@ class NetworkdNetDevTests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path('25-bridge.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('bridge99'))
+        self.assertTrue(self.wait_link_exits('bridge99'))
 
         self.assertEqual('900', self.read_link_attr('bridge99', 'bridge', 'hello_time'))
         self.assertEqual('900', self.read_link_attr('bridge99', 'bridge', 'max_age'))
@@ -187,7 +415,7 @@ class NetworkdNetDevTests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path('25-bond.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('bond99'))
+        self.assertTrue(self.wait_link_exits('bond99'))
 
         self.assertEqual('802.3ad 4',         self.read_link_attr('bond99', 'bonding', 'mode'))
         self.assertEqual('layer3+4 1',        self.read_link_attr('bond99', 'bonding', 'xmit_hash_policy'))
@@ -206,9 +434,9 @@ class NetworkdNetDevTests(unittest.TestCase, Utilities):
 
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('vlan99'))
+        self.assertTrue(self.wait_link_exits('vlan99'))
 
-        output = subprocess.check_output(['ip', '-d', 'link', 'show', 'vlan99']).rstrip().decode('utf-8')
+        output = self._show(ip_bin, '-d', 'link', 'show', 'vlan99')
         self.assertTrue(output, 'REORDER_HDR')
         self.assertTrue(output, 'LOOSE_BINDING')
         self.assertTrue(output, 'GVRP')
@@ -220,14 +448,14 @@ class NetworkdNetDevTests(unittest.TestCase, Utilities):
 
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('macvtap99'))
+        self.assertTrue(self.wait_link_exits('macvtap99'))
 
     def test_macvlan(self):
         self.copy_unit_to_networkd_unit_path('21-macvlan.netdev', '11-dummy.netdev', 'macvlan.network')
 
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('macvlan99'))
+        self.assertTrue(self.wait_link_exits('macvlan99'))
 
     @expectedFailureIfModuleIsNotAvailable('ipvlan')
     def test_ipvlan(self):
@@ -235,35 +463,35 @@ class NetworkdNetDevTests(unittest.TestCase, Utilities):
 
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('ipvlan99'))
+        self.assertTrue(self.wait_link_exits('ipvlan99'))
 
     def test_veth(self):
         self.copy_unit_to_networkd_unit_path('25-veth.netdev')
 
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
 
     def test_dummy(self):
         self.copy_unit_to_networkd_unit_path('11-dummy.netdev')
 
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('test1'))
+        self.assertTrue(self.wait_link_exits('test1'))
 
     def test_tun(self):
         self.copy_unit_to_networkd_unit_path('25-tun.netdev')
 
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('tun99'))
+        self.assertTrue(self.wait_link_exits('tun99'))
 
     def test_tap(self):
         self.copy_unit_to_networkd_unit_path('25-tap.netdev')
 
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('tap99'))
+        self.assertTrue(self.wait_link_exits('tap99'))
 
     @expectedFailureIfModuleIsNotAvailable('vrf')
     def test_vrf(self):
@@ -271,7 +499,7 @@ class NetworkdNetDevTests(unittest.TestCase, Utilities):
 
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('vrf99'))
+        self.assertTrue(self.wait_link_exits('vrf99'))
 
     @expectedFailureIfModuleIsNotAvailable('vcan')
     def test_vcan(self):
@@ -279,7 +507,7 @@ class NetworkdNetDevTests(unittest.TestCase, Utilities):
 
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('vcan99'))
+        self.assertTrue(self.wait_link_exits('vcan99'))
 
     @expectedFailureIfModuleIsNotAvailable('wireguard')
     def test_wireguard(self):
@@ -290,16 +518,16 @@ class NetworkdNetDevTests(unittest.TestCase, Utilities):
         if shutil.which('wg'):
             subprocess.call('wg')
 
-        self.assertTrue(self.link_exits('wg99'))
+        self.assertTrue(self.wait_link_exits('wg99'))
 
     def test_geneve(self):
         self.copy_unit_to_networkd_unit_path('25-geneve.netdev')
 
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('geneve99'))
+        self.assertTrue(self.wait_link_exits('geneve99'))
 
-        output = subprocess.check_output(['ip', '-d', 'link', 'show', 'geneve99']).rstrip().decode('utf-8')
+        output = self._show(ip_bin, '-d', 'link', 'show', 'geneve99')
         self.assertTrue(output, '192.168.22.1')
         self.assertTrue(output, '6082')
         self.assertTrue(output, 'udpcsum')
@@ -309,79 +537,79 @@ class NetworkdNetDevTests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path('12-dummy.netdev', '25-ipip-tunnel.netdev', 'ipip.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
-        self.assertTrue(self.link_exits('ipiptun99'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('ipiptun99'))
 
     def test_gre_tunnel(self):
         self.copy_unit_to_networkd_unit_path('12-dummy.netdev', '25-gre-tunnel.netdev', 'gretun.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
-        self.assertTrue(self.link_exits('gretun99'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('gretun99'))
 
     def test_gretap_tunnel(self):
         self.copy_unit_to_networkd_unit_path('12-dummy.netdev', '25-gretap-tunnel.netdev', 'gretap.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
-        self.assertTrue(self.link_exits('gretap99'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('gretap99'))
 
     def test_ip6gretap_tunnel(self):
         self.copy_unit_to_networkd_unit_path('12-dummy.netdev', '25-ip6gre-tunnel.netdev', 'ip6gretap.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
-        self.assertTrue(self.link_exits('ip6gretap99'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('ip6gretap99'))
 
     def test_vti_tunnel(self):
         self.copy_unit_to_networkd_unit_path('12-dummy.netdev', '25-vti-tunnel.netdev', 'vti.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
-        self.assertTrue(self.link_exits('vtitun99'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('vtitun99'))
 
     def test_vti6_tunnel(self):
         self.copy_unit_to_networkd_unit_path('12-dummy.netdev', '25-vti6-tunnel.netdev', 'vti6.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
-        self.assertTrue(self.link_exits('vti6tun99'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('vti6tun99'))
 
     def test_ip6tnl_tunnel(self):
         self.copy_unit_to_networkd_unit_path('12-dummy.netdev', '25-ip6tnl-tunnel.netdev', 'ip6tnl.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
-        self.assertTrue(self.link_exits('ip6tnl99'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('ip6tnl99'))
 
     def test_sit_tunnel(self):
         self.copy_unit_to_networkd_unit_path('12-dummy.netdev', '25-sit-tunnel.netdev', 'sit.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
-        self.assertTrue(self.link_exits('sittun99'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('sittun99'))
 
     def test_6rd_tunnel(self):
         self.copy_unit_to_networkd_unit_path('12-dummy.netdev', '25-6rd-tunnel.netdev', '6rd.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
-        self.assertTrue(self.link_exits('sittun99'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('sittun99'))
 
     def test_tunnel_independent(self):
         self.copy_unit_to_networkd_unit_path('25-ipip-tunnel-independent.netdev')
 
         self.start_networkd()
-        self.assertTrue(self.link_exits('ipiptun99'))
+        self.assertTrue(self.wait_link_exits('ipiptun99'))
 
     def test_vxlan(self):
         self.copy_unit_to_networkd_unit_path('25-vxlan.netdev', 'vxlan.network','11-dummy.netdev')
 
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('vxlan99'))
+        self.assertTrue(self.wait_link_exits('vxlan99'))
 
-        output = subprocess.check_output(['ip', '-d', 'link', 'show', 'vxlan99']).rstrip().decode('utf-8')
+        output = self._show(ip_bin, '-d', 'link', 'show', 'vxlan99')
         self.assertRegex(output, "999")
         self.assertRegex(output, '5555')
         self.assertRegex(output, 'l2miss')
@@ -394,11 +622,15 @@ class NetworkdNetDevTests(unittest.TestCase, Utilities):
         self.assertRegex(output, 'gbp')
 
 class NetworkdNetWorkTests(unittest.TestCase, Utilities):
+    RE_ADDRESS = re.compile(r'192\.168\.0\.15')
+    RE_GATEWAY = re.compile(r'192\.168\.0\.1')
+    RE_ROUTABLE = re.compile('routable')
+
     links = ['dummy98', 'test1', 'bond199']
 
     units = ['12-dummy.netdev', 'test-static.network', 'configure-without-carrier.network', '11-dummy.netdev',
-             '23-primary-slave.network', '23-test1-bond199.network', '11-dummy.netdev', '23-bond199.network',
-             '25-bond-active-backup-slave.netdev', '12-dummy.netdev', '23-active-slave.network',
+             '23-primary-slave.network', '23-test1-bond199.network', '23-bond199.network',
+             '25-bond-active-backup-slave.netdev', '23-active-slave.network',
              'routing-policy-rule.network', '25-address-section.network', '25-address-section-miscellaneous.network',
              '25-route-section.network', '25-route-type.network', '25-route-tcp-window-settings.network',
              '25-address-link-section.network', '25-ipv6-address-label-section.network', '25-link-section-unmanaged.network',
@@ -415,51 +647,52 @@ class NetworkdNetWorkTests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path('12-dummy.netdev', 'test-static.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
-        output = subprocess.check_output(['networkctl', 'status', 'dummy98']).rstrip().decode('utf-8')
-        print(output)
-        self.assertRegex(output, '192.168.0.15')
-        self.assertRegex(output, '192.168.0.1')
-        self.assertRegex(output, 'routable')
+        self.assertTrue(self.wait_link_exits('dummy98'))
+        output = self._wait_routable('dummy98')
+        _dbg(output)
+        self.assertRegex(output, self.RE_ADDRESS)
+        self.assertRegex(output, self.RE_GATEWAY)
+        self.assertRegex(output, self.RE_ROUTABLE)
 
     def test_configure_without_carrier(self):
         self.copy_unit_to_networkd_unit_path('configure-without-carrier.network', '11-dummy.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('test1'))
-        output = subprocess.check_output(['networkctl', 'status', 'test1']).rstrip().decode('utf-8')
-        print(output)
-        self.assertRegex(output, '192.168.0.15')
-        self.assertRegex(output, '192.168.0.1')
-        self.assertRegex(output, 'routable')
+        self.assertTrue(self.wait_link_exits('test1'))
+        output = self._wait_routable('test1')
+        _dbg(output)
+        self.assertRegex(output, self.RE_ADDRESS)
+        self.assertRegex(output, self.RE_GATEWAY)
+        self.assertRegex(output, self.RE_ROUTABLE)
 
     def test_bond_active_slave(self):
         self.copy_unit_to_networkd_unit_path('23-active-slave.network', '23-bond199.network', '25-bond-active-backup-slave.netdev', '12-dummy.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
-        self.assertTrue(self.link_exits('bond199'))
-        output = subprocess.check_output(['ip', '-d', 'link', 'show', 'bond199']).rstrip().decode('utf-8')
-        print(output)
+        self.assertTrue(self.wait_link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('bond199'))
+        output = self._show(ip_bin, '-d', 'link', 'show', 'bond199')
+        _dbg(output)
         self.assertRegex(output, 'active_slave dummy98')
 
     def test_bond_primary_slave(self):
         self.copy_unit_to_networkd_unit_path('23-primary-slave.network', '23-test1-bond199.network', '25-bond-active-backup-slave.netdev', '11-dummy.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('test1'))
-        self.assertTrue(self.link_exits('bond199'))
-        output = subprocess.check_output(['ip', '-d', 'link', 'show', 'bond199']).rstrip().decode('utf-8')
-        print(output)
+        self.assertTrue(self.wait_link_exits('test1'))
+        self.assertTrue(self.wait_link_exits('bond199'))
+        output = self._show(ip_bin, '-d', 'link', 'show', 'bond199')
+        _dbg(output)
         self.assertRegex(output, 'primary test1')
 
     def test_routing_policy_rule(self):
         self.copy_unit_to_networkd_unit_path('routing-policy-rule.network', '11-dummy.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('test1'))
-        output = subprocess.check_output(['ip', 'rule']).rstrip().decode('utf-8')
-        print(output)
+        self.assertTrue(self.wait_link_exits('test1'))
+        output = self._poll_output([ip_bin, 'rule'],
+                                   ('111', 'from 192.168.100.18', 'iif test1'))
+        _dbg(output)
         self.assertRegex(output, '111')
         self.assertRegex(output, 'from 192.168.100.18')
         self.assertRegex(output, r'tos (?:0x08|throughput)\s')
@@ -471,10 +704,10 @@ class NetworkdNetWorkTests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path('25-address-section-miscellaneous.network', '12-dummy.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
 
-        output = subprocess.check_output(['ip', 'address', 'show', 'dummy98']).rstrip().decode('utf-8')
-        print(output)
+        output = self._show(ip_bin, 'address', 'show', 'dummy98')
+        _dbg(output)
         self.assertRegex(output, 'inet 10.2.3.4/16 brd 10.2.255.255 scope link deprecated dummy98')
         self.assertRegex(output, 'inet6 2001:db8:0:f101::1/64 scope global')
 
@@ -482,10 +715,11 @@ class NetworkdNetWorkTests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path('25-route-section.network', '12-dummy.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
 
-        output = subprocess.check_output(['ip', 'route', 'list', 'dev', 'dummy98']).rstrip().decode('utf-8')
-        print(output)
+        output = self._poll_output([ip_bin, 'route', 'list', 'dev', 'dummy98'],
+                                   ('192.168.0.1', '192.168.0.0/24'))
+        _dbg(output)
         self.assertRegex(output, '192.168.0.1')
         self.assertRegex(output, 'static')
         self.assertRegex(output, '192.168.0.0/24')
@@ -494,26 +728,28 @@ class NetworkdNetWorkTests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path('25-route-type.network', '12-dummy.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
 
-        output = subprocess.check_output(['ip', 'route', 'list']).rstrip().decode('utf-8')
-        print(output)
+        output = self._poll_output([ip_bin, 'route', 'list'],
+                                   ('blackhole', 'unreachable', 'prohibit'))
+        _dbg(output)
         self.assertRegex(output, 'blackhole')
         self.assertRegex(output, 'unreachable')
         self.assertRegex(output, 'prohibit')
 
-        subprocess.call(['ip', 'route', 'del', 'blackhole', '202.54.1.2'])
-        subprocess.call(['ip', 'route', 'del', 'unreachable', '202.54.1.3'])
-        subprocess.call(['ip', 'route', 'del', 'prohibit', '202.54.1.4'])
+        subprocess.call([ip_bin, 'route', 'del', 'blackhole', '202.54.1.2'])
+        subprocess.call([ip_bin, 'route', 'del', 'unreachable', '202.54.1.3'])
+        subprocess.call([ip_bin, 'route', 'del', 'prohibit', '202.54.1.4'])
 
     def test_ip_route_tcp_window(self):
         self.copy_unit_to_networkd_unit_path('25-route-tcp-window-settings.network', '11-dummy.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('test1'))
+        self.assertTrue(self.wait_link_exits('test1'))
 
-        output = subprocess.check_output(['ip', 'route', 'list']).rstrip().decode('utf-8')
-        print(output)
+        output = self._poll_output([ip_bin, 'route', 'list'],
+                                   ('initcwnd 20', 'initrwnd 30'))
+        _dbg(output)
         self.assertRegex(output, 'initcwnd 20')
         self.assertRegex(output, 'initrwnd 30')
 
@@ -521,37 +757,45 @@ class NetworkdNetWorkTests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path('25-address-link-section.network', '12-dummy.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
 
-        output = subprocess.check_output(['ip', 'link', 'show', 'dummy98']).rstrip().decode('utf-8')
-        print(output)
+        output = self._show(ip_bin, 'link', 'show', 'dummy98')
+        _dbg(output)
         self.assertRegex(output, '00:01:02:aa:bb:cc')
 
     def test_ip_link_unmanaged(self):
         self.copy_unit_to_networkd_unit_path('25-link-section-unmanaged.network', '12-dummy.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
 
-        output = subprocess.check_output(['networkctl', 'status', 'dummy98']).rstrip().decode('utf-8')
-        print(output)
+        output = self._show(networkctl_bin, 'status', 'dummy98')
+        _dbg(output)
         self.assertRegex(output, 'unmanaged')
 
     def test_ipv6_address_label(self):
         self.copy_unit_to_networkd_unit_path('25-ipv6-address-label-section.network', '12-dummy.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
 
-        output = subprocess.check_output(['ip', 'addrlabel', 'list']).rstrip().decode('utf-8')
-        print(output)
+        output = self._show(ip_bin, 'addrlabel', 'list')
+        _dbg(output)
         self.assertRegex(output, '2004:da8:1::/64')
 
     def test_sysctl(self):
         self.copy_unit_to_networkd_unit_path('25-sysctl.network', '12-dummy.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
+
+        # the sysctl values are written asynchronously once the link is
+        # up, so give networkd a moment to get them all in place
+        deadline = time.monotonic() + 10
+        while self.read_ipv6_sysctl_attr('dummy98', 'forwarding') != '1':
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.1)
 
         self.assertEqual(self.read_ipv6_sysctl_attr('dummy98', 'forwarding'), '1')
         self.assertEqual(self.read_ipv6_sysctl_attr('dummy98', 'use_tempaddr'), '2')
@@ -562,6 +806,9 @@ class NetworkdNetWorkTests(unittest.TestCase, Utilities):
         self.assertEqual(self.read_ipv4_sysctl_attr('dummy98', 'proxy_arp'), '1')
 
 class NetworkdNetWorkBrideTests(unittest.TestCase, Utilities):
+    RE_MASTER = re.compile('master')
+    RE_BRIDGE = re.compile('bridge')
+
     links = ['dummy98', 'test1', 'bridge99']
 
     units = ['11-dummy.netdev', '12-dummy.netdev', '26-bridge.netdev', '26-bridge-slave-interface-1.network',
@@ -580,27 +827,31 @@ class NetworkdNetWorkBrideTests(unittest.TestCase, Utilities):
                                              'bridge99.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
-        self.assertTrue(self.link_exits('test1'))
-        self.assertTrue(self.link_exits('bridge99'))
-
-        output = subprocess.check_output(['ip', '-d', 'link', 'show', 'test1']).rstrip().decode('utf-8')
-        print(output)
-        self.assertRegex(output, 'master')
-        self.assertRegex(output, 'bridge')
-
-        output = subprocess.check_output(['ip', '-d', 'link', 'show', 'dummy98']).rstrip().decode('utf-8')
-        print(output)
-        self.assertRegex(output, 'master')
-        self.assertRegex(output, 'bridge')
-
-        output = subprocess.check_output(['ip', 'addr', 'show', 'bridge99']).rstrip().decode('utf-8')
-        print(output)
+        self.assertTrue(self.wait_link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('test1'))
+        self.assertTrue(self.wait_link_exits('bridge99'))
+
+        output = self._poll_output([ip_bin, '-d', 'link', 'show', 'test1'],
+                                   (self.RE_MASTER, self.RE_BRIDGE))
+        _dbg(output)
+        self.assertRegex(output, self.RE_MASTER)
+        self.assertRegex(output, self.RE_BRIDGE)
+
+        output = self._poll_output([ip_bin, '-d', 'link', 'show', 'dummy98'],
+                                   (self.RE_MASTER, self.RE_BRIDGE))
+        _dbg(output)
+        self.assertRegex(output, self.RE_MASTER)
+        self.assertRegex(output, self.RE_BRIDGE)
+
+        output = self._poll_output([ip_bin, 'addr', 'show', 'bridge99'],
+                                   ('192.168.0.15', '192.168.0.1'))
+        _dbg(output)
         self.assertRegex(output, '192.168.0.15')
         self.assertRegex(output, '192.168.0.1')
 
-        output = subprocess.check_output(['bridge', '-d', 'link', 'show', 'dummy98']).rstrip().decode('utf-8')
-        print(output)
+        output = self._poll_output([bridge_bin, '-d', 'link', 'show', 'dummy98'],
+                                   ('cost 400', 'hairpin on', 'flood on', 'fastleave on'))
+        _dbg(output)
         self.assertRegex(output, 'cost 400')
         self.assertRegex(output, 'hairpin on')
         self.assertRegex(output, 'flood on')
@@ -622,10 +873,11 @@ class NetworkdNetWorkLLDPTests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path('23-emit-lldp.network', '24-lldp.network', '25-veth.netdev')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
 
-        output = subprocess.check_output(['networkctl', 'lldp']).rstrip().decode('utf-8')
-        print(output)
+        output = self._poll_output([networkctl_bin, 'lldp'],
+                                   ('veth-peer', 'veth99'), timeout=30)
+        _dbg(output)
         self.assertRegex(output, 'veth-peer')
         self.assertRegex(output, 'veth99')
 
@@ -645,10 +897,11 @@ class NetworkdNetworkRATests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'ipv6-prefix.network', 'ipv6-prefix-veth.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
 
-        output = subprocess.check_output(['networkctl', 'status', 'veth99']).rstrip().decode('utf-8')
-        print(output)
+        output = self._poll_output([networkctl_bin, 'status', 'veth99'],
+                                   ('2002:da8:1:0',), timeout=30)
+        _dbg(output)
         self.assertRegex(output, '2002:da8:1:0')
 
 class NetworkdNetworkDHCPServerTests(unittest.TestCase, Utilities):
@@ -668,12 +921,10 @@ class NetworkdNetworkDHCPServerTests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-client.network', 'dhcp-server.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
-
-        time.sleep(5)
+        self.assertTrue(self.wait_link_exits('veth99'))
 
-        output = subprocess.check_output(['networkctl', 'status', 'veth99']).rstrip().decode('utf-8')
-        print(output)
+        output = self._wait_routable('veth99')
+        _dbg(output)
         self.assertRegex(output, '192.168.5.*')
         self.assertRegex(output, 'Gateway: 192.168.5.1')
         self.assertRegex(output, 'DNS: 192.168.5.1')
@@ -683,10 +934,10 @@ class NetworkdNetworkDHCPServerTests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path( '12-dummy.netdev', '24-search-domain.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('dummy98'))
+        self.assertTrue(self.wait_link_exits('dummy98'))
 
-        output = subprocess.check_output(['networkctl', 'status', 'dummy98']).rstrip().decode('utf-8')
-        print(output)
+        output = self._wait_routable('dummy98')
+        _dbg(output)
         self.assertRegex(output, 'Address: 192.168.42.100')
         self.assertRegex(output, 'DNS: 192.168.42.1')
         self.assertRegex(output, 'Search Domains: one')
@@ -695,15 +946,29 @@ class NetworkdNetworkDHCPServerTests(unittest.TestCase, Utilities):
         self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-client-timezone-router.network', 'dhcp-server-timezone-router.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
 
-        output = subprocess.check_output(['networkctl', 'status', 'veth99']).rstrip().decode('utf-8')
-        print(output)
+        output = self._wait_routable('veth99')
+        _dbg(output)
         self.assertRegex(output, 'Gateway: 192.168.5.*')
         self.assertRegex(output, '192.168.5.*')
         self.assertRegex(output, 'Europe/Berlin')
 
 class NetworkdNetworkDHCPClientTests(unittest.TestCase, Utilities):
+    RE_V6 = re.compile(b'2600::')
+    RE_V4 = re.compile(rb'192\.168\.5')
+    RE_ROUTER = re.compile(rb'192\.168\.5\.1')
+    RE_MAC = re.compile(b'12:34:56:78:9a:bc')
+    # anchored to the line start and without '.*' so the engine can
+    # reject non-matching lines of the route dump outright
+    RE_DEFAULT_ROUTE = re.compile(rb'^default\s[^\n]*dev veth99 proto dhcp', re.M)
+    RE_DHCP_ROUTE = re.compile(b'veth99 proto dhcp')
+    RE_METRIC = re.compile(b'metric 24')
+
+    # unit sets shared by several tests below
+    UNITS_DHCP_SERVER = ('25-veth.netdev', 'dhcp-server-veth-peer.network')
+    UNITS_DHCP_V4_SERVER = ('25-veth.netdev', 'dhcp-v4-server-veth-peer.network')
+
     links = ['veth99', 'dummy98']
 
     units = ['25-veth.netdev', 'dhcp-server-veth-peer.network','dhcp-client-ipv6-only.network',
@@ -725,170 +990,195 @@ class NetworkdNetworkDHCPClientTests(unittest.TestCase, Utilities):
         self.remove_log_file()
 
     def test_dhcp_client_ipv6_only(self):
-        self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-server-veth-peer.network','dhcp-client-ipv6-only.network')
+        self.copy_unit_to_networkd_unit_path(*self.UNITS_DHCP_SERVER,'dhcp-client-ipv6-only.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
 
         self.start_dnsmasq()
+        self._wait_routable('veth99')
 
-        output = subprocess.check_output(['networkctl', 'status', 'veth99']).rstrip().decode('utf-8')
-        print(output)
-        self.assertRegex(output, '2600::')
-        self.assertNotRegex(output, '192.168.5')
+        output = self._run(networkctl_bin, 'status', 'veth99')
+        _dbg(output)
+        self.assertRegex(output, self.RE_V6)
+        self.assertNotRegex(output, self.RE_V4)
 
     def test_dhcp_client_ipv4_only(self):
-        self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-server-veth-peer.network','dhcp-client-ipv4-only-ipv6-disabled.network')
+        self.copy_unit_to_networkd_unit_path(*self.UNITS_DHCP_SERVER,'dhcp-client-ipv4-only-ipv6-disabled.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
 
         self.start_dnsmasq()
+        self._wait_routable('veth99')
 
-        output = subprocess.check_output(['networkctl', 'status', 'veth99']).rstrip().decode('utf-8')
-        print(output)
-        self.assertNotRegex(output, '2600::')
-        self.assertRegex(output, '192.168.5')
+        output = self._run(networkctl_bin, 'status', 'veth99')
+        _dbg(output)
+        self.assertNotRegex(output, self.RE_V6)
+        self.assertRegex(output, self.RE_V4)
 
     def test_dhcp_client_ipv4_ipv6(self):
-        self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-server-veth-peer.network', 'dhcp-client-ipv6-only.network',
+        self.copy_unit_to_networkd_unit_path(*self.UNITS_DHCP_SERVER, 'dhcp-client-ipv6-only.network',
                                              'dhcp-client-ipv4-only.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
 
         self.start_dnsmasq()
+        self._wait_routable('veth99')
 
-        output = subprocess.check_output(['networkctl', 'status', 'veth99']).rstrip().decode('utf-8')
-        print(output)
-        self.assertRegex(output, '2600::')
-        self.assertRegex(output, '192.168.5')
+        output = self._run(networkctl_bin, 'status', 'veth99')
+        _dbg(output)
+        self.assertRegex(output, self.RE_V6)
+        self.assertRegex(output, self.RE_V4)
 
     def test_dhcp_client_settings(self):
-        self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-server-veth-peer.network', 'dhcp-client-ipv4-dhcp-settings.network')
+        self.copy_unit_to_networkd_unit_path(*self.UNITS_DHCP_SERVER, 'dhcp-client-ipv4-dhcp-settings.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
 
         self.start_dnsmasq()
+        self._wait_routable('veth99')
+
+        # MAC address and MTU come straight from sysfs, only the
+        # acquired address and route actually need the ip queries
+        with open('/sys/class/net/veth99/address') as f:
+            self.assertEqual(f.read().strip(), '12:34:56:78:9a:bc')
+        with open('/sys/class/net/veth99/mtu') as f:
+            self.assertEqual(f.read().strip(), '1492')
 
-        output = subprocess.check_output(['ip', 'address', 'show', 'dev', 'veth99']).rstrip().decode('utf-8')
-        print(output)
-        self.assertRegex(output, '12:34:56:78:9a:bc')
-        self.assertRegex(output, '192.168.5')
-        self.assertRegex(output, '1492')
+        address_output, route_output = self._show_batch((ip_bin, '-4', 'address', 'show', 'dev', 'veth99'),
+                                                        (ip_bin, 'route'))
+        _dbg(address_output)
+        self.assertRegex(address_output, self.RE_V4)
 
-        output = subprocess.check_output(['ip', 'route']).rstrip().decode('utf-8')
-        print(output)
-        self.assertRegex(output, 'default.*dev veth99 proto dhcp')
+        _dbg(route_output)
+        self.assertRegex(route_output, self.RE_DEFAULT_ROUTE)
 
-        self.search_words_in_file('vendor class: SusantVendorTest')
-        self.search_words_in_file('client MAC address: 12:34:56:78:9a:bc')
-        self.search_words_in_file('client provides name: test-hostname')
-        self.search_words_in_file('26:mtu')
+        words = (needle_vendor_class, needle_client_mac,
+                 needle_client_hostname, needle_mtu)
+        self.assertEqual(self.scan_words_in_file(*words), set(words))
 
     def test_dhcp6_client_settings_rapidcommit_true(self):
-        self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-server-veth-peer.network', 'dhcp-client-ipv6-only.network')
+        self.copy_unit_to_networkd_unit_path(*self.UNITS_DHCP_SERVER, 'dhcp-client-ipv6-only.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
 
         self.start_dnsmasq()
+        self._wait_routable('veth99')
 
-        output = subprocess.check_output(['ip', 'address', 'show', 'dev', 'veth99']).rstrip().decode('utf-8')
-        print(output)
-        self.assertRegex(output, '12:34:56:78:9a:bc')
+        output = self._run(ip_bin, 'address', 'show', 'dev', 'veth99')
+        _dbg(output)
+        self.assertRegex(output, self.RE_MAC)
 
-        self.assertTrue(self.search_words_in_file('14:rapid-commit'))
+        self.assertTrue(self.search_words_in_file(needle_rapid_commit))
 
     def test_dhcp6_client_settings_rapidcommit_false(self):
-        self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-server-veth-peer.network', 'dhcp-client-ipv6-rapid-commit.network')
+        self.copy_unit_to_networkd_unit_path(*self.UNITS_DHCP_SERVER, 'dhcp-client-ipv6-rapid-commit.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
 
         self.start_dnsmasq()
+        self._wait_routable('veth99')
 
-        output = subprocess.check_output(['ip', 'address', 'show', 'dev', 'veth99']).rstrip().decode('utf-8')
-        print(output)
-        self.assertRegex(output, '12:34:56:78:9a:bc')
+        output = self._run(ip_bin, 'address', 'show', 'dev', 'veth99')
+        _dbg(output)
+        self.assertRegex(output, self.RE_MAC)
 
-        self.assertFalse(self.search_words_in_file('14:rapid-commit'))
+        self.assertFalse(self.search_words_in_file(needle_rapid_commit))
 
     def test_dhcp_client_settings_anonymize(self):
-        self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-server-veth-peer.network', 'dhcp-client-anonymize.network')
+        self.copy_unit_to_networkd_unit_path(*self.UNITS_DHCP_SERVER, 'dhcp-client-anonymize.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
 
         self.start_dnsmasq()
-        self.assertFalse(self.search_words_in_file('VendorClassIdentifier=SusantVendorTest'))
-        self.assertFalse(self.search_words_in_file('test-hostname'))
-        self.assertFalse(self.search_words_in_file('26:mtu'))
+        self.assertFalse(self.scan_words_in_file(needle_vci, needle_hostname, needle_mtu))
 
     def test_dhcp_client_listen_port(self):
-        self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-server-veth-peer.network', 'dhcp-client-listen-port.network')
-        dh_server = DHCPServer("dhcp_server")
-        dh_server.start()
+        # bind the pretend server socket before networkd starts the
+        # client, so the first discover cannot be missed
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('0.0.0.0', 67))
+        sock.setblocking(False)
+        self.addCleanup(sock.close)
 
+        self.copy_unit_to_networkd_unit_path(*self.UNITS_DHCP_SERVER, 'dhcp-client-listen-port.network')
         self.start_networkd()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
 
-        global port
-        global ip
+        ready, _, _ = select.select([sock], [], [], 10)
+        self.assertTrue(ready, 'no DHCP discover received within 10 seconds')
 
-        self.assertRegex(str(port), '5555')
-        self.assertRegex(str(ip), '0.0.0.0')
-
-        dh_server.join()
+        data, (ip, port) = sock.recvfrom(4096)
+        self.assertEqual(port, 5555)
+        self.assertEqual(ip, '0.0.0.0')
 
     def test_dhcp_route_table_id(self):
-        self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-v4-server-veth-peer.network', 'dhcp-client-route-table.network')
+        self.copy_unit_to_networkd_unit_path(*self.UNITS_DHCP_V4_SERVER, 'dhcp-client-route-table.network')
         self.start_networkd()
         self.start_dnsmasq()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
+        self._wait_routable('veth99')
 
-        output = subprocess.check_output(['ip', 'route', 'show', 'table', '12']).rstrip().decode('utf-8')
-        print(output)
+        output = self._run(ip_bin, '-4', 'route', 'show', 'table', '12')
+        _dbg(output)
 
-        self.assertRegex(output, 'veth99 proto dhcp')
-        self.assertRegex(output, '192.168.5.1')
+        self.assertRegex(output, self.RE_DHCP_ROUTE)
+        self.assertRegex(output, self.RE_ROUTER)
 
     def test_dhcp_route_metric(self):
-        self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-v4-server-veth-peer.network', 'dhcp-client-route-metric.network')
+        self.copy_unit_to_networkd_unit_path(*self.UNITS_DHCP_V4_SERVER, 'dhcp-client-route-metric.network')
         self.start_networkd()
         self.start_dnsmasq()
 
-        self.assertTrue(self.link_exits('veth99'))
+        self.assertTrue(self.wait_link_exits('veth99'))
+        self._wait_routable('veth99')
 
-        output = subprocess.check_output(['ip', 'route', 'show', 'dev', 'veth99']).rstrip().decode('utf-8')
-        print(output)
+        output = self._run(ip_bin, '-4', 'route', 'show', 'dev', 'veth99')
+        _dbg(output)
 
-        self.assertRegex(output, 'metric 24')
+        self.assertRegex(output, self.RE_METRIC)
 
     def test_dhcp_route_criticalconnection_true(self):
-        self.copy_unit_to_networkd_unit_path('25-veth.netdev', 'dhcp-v4-server-veth-peer.network', 'dhcp-client-critical-connection.network')
+        self.copy_unit_to_networkd_unit_path(*self.UNITS_DHCP_V4_SERVER, 'dhcp-client-critical-connection.network')
         self.start_networkd()
-        self.start_dnsmasq()
-
-        self.assertTrue(self.link_exits('veth99'))
+        # the two minutes are the shortest lease dnsmasq accepts
+        self.start_dnsmasq(lease_time='2m')
 
-        output = subprocess.check_output(['networkctl', 'status', 'veth99']).rstrip().decode('utf-8')
-        print(output)
+        self.assertTrue(self.wait_link_exits('veth99'))
+        self._wait_routable('veth99')
 
-        self.assertRegex(output, '192.168.5.*')
+        # No status check up front: the routable wait above already
+        # covers it, and the poll below watches the address anyway.
         # Stoping dnsmasq as networkd won't be allowed to renew the DHCP lease.
         self.stop_dnsmasq(dnsmasq_pid_file)
 
-        # Sleep for 120 sec as the dnsmasq minimum lease time can only be set to 120
-        time.sleep(125)
+        # Wait out the lease, polling instead of sleeping blindly: if
+        # networkd drops the address despite CriticalConnection=true the
+        # test fails right away instead of two minutes later.
+        deadline = time.monotonic() + 130
+        while time.monotonic() < deadline:
+            output = self._run(ip_bin, 'address', 'show', 'dev', 'veth99')
+            if not re.search(rb'192\.168\.5\.', output):
+                self.fail('DHCP address was dropped despite CriticalConnection=true')
+            time.sleep(5)
 
-        output = subprocess.check_output(['networkctl', 'status', 'veth99']).rstrip().decode('utf-8')
-        print(output)
-        self.assertRegex(output, '192.168.5.*')
+        output = self._run(networkctl_bin, 'status', 'veth99')
+        _dbg(output)
+        self.assertRegex(output, rb'192\.168\.5\.')
 
 if __name__ == '__main__':
+    # The tests have to run serially: they all drive the single system
+    # instance of systemd-networkd, share /var/run/systemd/network and
+    # reuse link names (dummy98, veth99, ...) across classes, so a
+    # parallel runner would make them trample on each other's state.
     unittest.main(testRunner=unittest.TextTestRunner(stream=sys.stdout,
-                                                     verbosity=3))
+                                                     verbosity=3 if _verbose else 1))